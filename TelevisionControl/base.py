@@ -1,14 +1,89 @@
 from roku import Roku
+from requests.adapters import HTTPAdapter
+import requests
 from adb_shell.auth.sign_pythonrsa import PythonRSASigner
-from androidtv import AndroidTVSync
-from adb_shell.auth.keygen import keygen
+from androidtv.androidtv.androidtv_async import AndroidTVAsync
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import base64
+import getpass
+import logging
 import os
-import subprocess
+import socket
+import struct
+import queue
+import threading
 import PySimpleGUI as sg
 
+logger = logging.getLogger(__name__)
+
+# snapshot the environment once so a reconnect uses the same settings as startup
+# adb_server_ip is optional, without it the android TVs are reached directly over TCP
+ADB_SERVER_IP = os.getenv('adb_server_ip')
+TV_IPS = {
+    'TopTV': os.getenv('TopTVIP'),
+    'RightTV': os.getenv('RightTVIP'),
+    'LeftTV': os.getenv('LeftTVIP')
+}
+
+# all android tv I/O runs on one event loop in a background thread, so commands to several TVs can be in flight at once
+_android_loop = asyncio.new_event_loop()
+threading.Thread(target=_android_loop.run_forever, daemon=True).start()
+
+
+# Roku already reuses one requests session for every command, this gives that session a small connection pool
+class KeepAliveRoku(Roku):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the Roku only creates its session on the first command if none is set, so this one is used from the start
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+        session.headers['Connection'] = 'keep-alive'
+        self._conn = session
+
+
+# encode an RSA public key in the format adb expects in adbkey.pub, the same as adb_shell's keygen writes
+# the key is packed as its length in 32-bit words, -1 / n mod 2^32, the modulus, R^2 mod n, and the exponent
+def _android_pubkey(private_key):
+    numbers = private_key.public_key().public_numbers()
+    words = private_key.key_size // 32
+    n0inv = (1 << 32) - pow(numbers.n, -1, 1 << 32)
+    rr = pow(2, private_key.key_size * 2, numbers.n)
+    key_struct = (struct.pack('<LL', words, n0inv) + numbers.n.to_bytes(words * 4, 'little') +
+                  rr.to_bytes(words * 4, 'little') + struct.pack('<L', numbers.e))
+    # fall back to unknown like adb_shell does, getuser() raises when no user can be found
+    try:
+        username = getpass.getuser()
+    except Exception:
+        username = 'unknown'
+    return base64.b64encode(key_struct).decode() + f" {username}@{socket.gethostname()}"
+
+
+# create the android tv controller on the android event loop and complete the adb connection
+# adb_connect() reports an unreachable TV by returning False, so that is raised here rather than handing back a dead tv
+async def _android_connect(ip_address, **params):
+    android = AndroidTVAsync(ip_address, **params)
+    if not await android.adb_connect():
+        await android.adb_close()
+        raise ConnectionError(f"Unable to connect to the android tv at {ip_address}")
+    return android
+
+
+# schedule an android tv command on the android event loop, the returned future only needs waiting on for a result
+def _android_send(command):
+    return asyncio.run_coroutine_threadsafe(command(), _android_loop)
+
 
 # Television class to connect to the TV and send basic remote commands
 class Television:
+    # ADB signer built from the key pair in ~/.android, shared by all android televisions
+    # the lock keeps televisions connecting at the same time from reading the key files more than once
+    _signer_cache = None
+    _signer_lock = threading.Lock()
+
     def __init__(self, name, operating_system: str, ip_address=None):
         # Name the TV, record the operating system, and initialize mute status and OS variables
         self.name = name
@@ -18,119 +93,226 @@ class Television:
                 "Operating system must be Roku or Android. No other operating systems are currently supported.")
         else:
             self.operating_system = operating_system
-        # the roku and android attributes will become Roku or AndroidTVSync instances after a successful connection
+        # the roku and android attributes will become Roku or AndroidTVAsync instances after a successful connection
         # one of attributes will be used as the controller to send commands through
         self.roku = None
         self.android = None
         self._muted = None
+        self._ip_address = None
+        # called with a message when a queued command fails, TelevisionGUI sets this to show the message in a popup
+        self.on_error = None
+        # holds the one live android connection between commands, None once a command has lost the connection
+        self._android_pool = queue.LifoQueue(maxsize=1)
+        # guards swapping the pool on a re-connect against a finishing command returning its connection to the old one
+        self._android_pool_lock = threading.Lock()
+        # remote commands bound to the connected controller, filled in by connect() so each command is one lookup
+        # until then every command does nothing, same as a remote pointed at a TV that is off
+        self._cmds = dict.fromkeys(['right', 'left', 'down', 'up', 'select', 'back', 'mute'], lambda: None)
+        # remote commands are queued and run in order on a background thread so a slow TV never freezes the GUI
+        self._q = queue.Queue()
+        threading.Thread(target=self._run_commands, daemon=True).start()
         # If an ip address is passed during initialization, the Television instance will autoconnect
         if ip_address:
             self.connect(ip_address)
 
+    # run queued remote commands one at a time, a failed command is reported without stopping the worker
+    def _run_commands(self):
+        while True:
+            fn = self._q.get()
+            try:
+                fn()
+            except Exception as e:
+                self._report_error(f"{self.name} command failed: {e}")
+
+    # commands run away from the GUI thread, so failures go to on_error when it is set and are logged otherwise
+    def _report_error(self, message):
+        if self.on_error:
+            self.on_error(message)
+        else:
+            logger.error(message)
+
+    # android commands finish on the event loop after _run_commands has moved on, so their failures are reported here
+    def _report_failure(self, future):
+        e = None if future.cancelled() else future.exception()
+        if e:
+            self._report_error(f"{self.name} command failed: {e}")
+
+    # the signer is shared by every Television, so the key files are only read the first time an android tv connects
+    @classmethod
+    def _get_signer(cls):
+        if cls._signer_cache is None:
+            with cls._signer_lock:
+                if cls._signer_cache is None:
+                    # reuse an existing key pair so the TV stays authorized
+                    private_key_path = os.path.expanduser('~/.android/adbkey')
+                    if os.path.exists(private_key_path):
+                        with open(private_key_path, 'rb') as f:
+                            priv = f.read()
+                        if os.path.exists(private_key_path + '.pub'):
+                            with open(private_key_path + '.pub', 'r') as f:
+                                pub = f.read()
+                            # instantiate the PythonRSASigner with the saved keys
+                            cls._signer_cache = PythonRSASigner(pub, priv)
+                        else:
+                            # the public key can be rebuilt from the private key, which keeps the TV authorized
+                            pub = _android_pubkey(serialization.load_pem_private_key(priv, None))
+                            cls._signer_cache = PythonRSASigner(pub, priv)
+                            with open(private_key_path + '.pub', 'w') as f:
+                                f.write(pub)
+                    else:
+                        # generate the key pair in memory, PythonRSASigner only loads PKCS8 private keys
+                        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+                        priv = private_key.private_bytes(serialization.Encoding.PEM,
+                                                         serialization.PrivateFormat.PKCS8,
+                                                         serialization.NoEncryption())
+                        pub = _android_pubkey(private_key)
+                        # build the signer before saving so a key it cannot load is never left on disk
+                        cls._signer_cache = PythonRSASigner(pub, priv)
+                        # save the key pair once, no need to read back what was just written
+                        os.makedirs(os.path.dirname(private_key_path), exist_ok=True)
+                        with open(private_key_path, 'wb') as f:
+                            f.write(priv)
+                        with open(private_key_path + '.pub', 'w') as f:
+                            f.write(pub)
+        return cls._signer_cache
+
+    # create a fresh android connection to the tv
+    def _connect_android(self):
+        params = {'signer': Television._get_signer(), 'adb_server_ip': ADB_SERVER_IP}
+        # adb_connect() opens the socket and performs the auth exchange itself
+        self.android = asyncio.run_coroutine_threadsafe(_android_connect(self._ip_address, **params),
+                                                        _android_loop).result()
+        return self.android
+
+    # send a command through the pooled android connection, the connection is taken out of the pool while the command
+    # is in flight so only one command talks to the TV at a time
+    def _android_command(self, method):
+        pool = self._android_pool
+        android = pool.get()
+        try:
+            if android is None:
+                # the last command lost the connection, so reconnect before sending this one
+                android = self._connect_android()
+            future = _android_send(getattr(android, method))
+        except Exception:
+            pool.put(None)
+            raise
+        future.add_done_callback(self._report_failure)
+        future.add_done_callback(partial(self._release_android, pool, android))
+        return future
+
+    # return the connection to the pool once its command finishes, a failed command or a connection that is no longer
+    # available is closed and replaced with None so the next command reconnects
+    # if connect() has replaced the pool in the meantime, the connection is closed instead of being returned
+    def _release_android(self, pool, android, future):
+        with self._android_pool_lock:
+            if pool is not self._android_pool:
+                _android_send(android.adb_close)
+            elif future.cancelled() or future.exception() or not android.available:
+                _android_send(android.adb_close)
+                pool.put(None)
+            else:
+                pool.put(android)
+
+    # install a new pool and close the connection left in the old one, a connection still held by a command is closed
+    # by _release_android once that command finishes
+    def _replace_android_pool(self, pool):
+        with self._android_pool_lock:
+            old_pool, self._android_pool = self._android_pool, pool
+            try:
+                old = old_pool.get_nowait()
+            except queue.Empty:
+                old = None
+        if old is not None:
+            _android_send(old.adb_close)
+
     # connect() needs to be run successfully prior to any other commands
     # you will need the ip address of your television to proceed
     def connect(self, ip_address):
         if self.operating_system.lower() == 'roku':
             # the roku OS is much friendlier to python with the Roku package
-            self.roku = Roku(ip_address)
+            self.roku = KeepAliveRoku(ip_address)
         elif self.operating_system.lower() == 'android':
-            # format command text to be run as a subprocess command
-            command = ("adb connect " + ip_address + ":5555")
-            # send command
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            out, err = process.communicate()
-            # generate the key pair and save the private key
-            private_key_path = os.path.expanduser('~/.android/adbkey')
-            keygen(private_key_path)
-            with open(private_key_path, 'rb') as f:
-                priv = f.read()
-            with open(os.path.expanduser('~/.android/adbkey.pub'), 'r') as f:
-                pub = f.read()
-            # instantiate the PythonRSASigner with the generated keys
-            signer = PythonRSASigner(pub, priv)
-            params = {'adb_server_ip': os.getenv('adb_server_ip')}
-            # connect to the android tv
-            self.android = AndroidTVSync(ip_address, signer=signer, **params)
-            self.android.adb_connect()
+            # the address is kept even if the connect fails, so later commands retry the tv the user asked for
+            self._ip_address = ip_address
+            # start a new pool so commands still in flight on an old connection cannot return it to this one
+            pool = queue.LifoQueue(maxsize=1)
+            try:
+                pool.put(self._connect_android())
+            except Exception:
+                # the pool must never be left empty, None makes the next command retry the connection
+                pool.put(None)
+                raise
+            finally:
+                self._replace_android_pool(pool)
+        # bind each remote command to the controller once, android names select and mute differently than roku
+        if self.roku:
+            self._cmds = {'right': self.roku.right, 'left': self.roku.left, 'down': self.roku.down,
+                          'up': self.roku.up, 'select': self.roku.select, 'back': self.roku.back,
+                          'mute': self.roku.volume_mute}
+        else:
+            # android commands are coroutines, so they are sent to the android event loop without waiting on them
+            self._cmds = {'right': partial(self._android_command, 'right'),
+                          'left': partial(self._android_command, 'left'),
+                          'down': partial(self._android_command, 'down'),
+                          'up': partial(self._android_command, 'up'),
+                          'select': partial(self._android_command, 'enter'),
+                          'back': partial(self._android_command, 'back'),
+                          'mute': partial(self._android_command, 'mute_volume')}
         # Assuming connection is during boot up, the TV will not be muted
-        self.muted(False)
+        self._muted = False
 
     @property
     def muted(self):
-        # if this is the first check of the muted attribute, get (android) or set (roku) the mute status on the TV
-        # and record it
-        if self._muted is None:
-            if self.roku:
-                # I am unable to check if the roku tv is muted so I am forced to turn on the sound via dialing the
-                # volume up and back down
-                self.roku.volume_up()
-                self.roku.volume_down()
-                self._muted = False
-            elif self.android:
-                self._muted = self.android.get_properties_dict().get('is_volume_muted')
+        # the mute status is tracked locally from connect() and toggle_mute() rather than asked of the TV each time
         return self._muted
 
     @muted.setter
     def muted(self, value: bool):
         self._muted = value
 
-    def toggle_mute(self):
-        # both roku and android allow you to perform toggle mute the same as a TV remote mute button
+    # re-sync the tracked mute status with the TV, in case it was muted with the real remote
+    def refresh_mute_state(self):
         if self.roku:
-            self.roku.volume_mute()
+            # I am unable to check if the roku tv is muted, so assume it is not as it would be after boot up
+            self._muted = False
         elif self.android:
-            self.android.mute_volume()
-        if self.muted:
-            self.muted = False
-        else:
-            self.muted = True
+            self._muted = self._android_command('get_properties_dict').result(timeout=5).get('is_volume_muted')
+        return self._muted
+
+    def toggle_mute(self):
+        # both roku and android allow you to perform toggle mute the same as a TV remote mute button
+        self._cmds['mute']()
+        self._muted = not self._muted
 
     def mute(self):
-        if not self.muted:
+        if not self._muted:
             self.toggle_mute()
-        self.muted = True
+        self._muted = True
 
     def unmute(self):
-        if self.muted:
+        if self._muted:
             self.toggle_mute()
-        self.muted = False
+        self._muted = False
 
     def right(self):
-        if self.roku:
-            self.roku.right()
-        elif self.android:
-            self.android.right()
+        return self._cmds['right']()
 
     def left(self):
-        if self.roku:
-            self.roku.left()
-        elif self.android:
-            self.android.left()
+        return self._cmds['left']()
 
     def down(self):
-        if self.roku:
-            self.roku.down()
-        elif self.android:
-            self.android.down()
+        return self._cmds['down']()
 
     def up(self):
-        if self.roku:
-            self.roku.up()
-        elif self.android:
-            self.android.up()
+        return self._cmds['up']()
 
     def select(self):
         # select is the equivalent of clicking the center button on a remote dpad, aka select or enter
-        if self.roku:
-            self.roku.select()
-        elif self.android:
-            self.android.enter()
+        return self._cmds['select']()
 
     def back(self):
-        if self.roku:
-            self.roku.back()
-        elif self.android:
-            self.android.back()
+        return self._cmds['back']()
 
 
 # PySimpleGUI to create a virtual remote control where you can flip between which tv to control
@@ -139,14 +321,23 @@ class Television:
 class TelevisionGUI:
     def __init__(self):
         # As described above, the tv layout and assignment is specific to my room
+        missing = [name for name, ip in TV_IPS.items() if ip is None]
+        if missing:
+            raise RuntimeError(f"No ip address set for {', '.join(missing)}. Set the TopTVIP, RightTVIP and LeftTVIP "
+                               f"environment variables.")
         self.tvs = {
             'TopTV': Television('TopTV', 'roku'),
             'RightTV': Television('RightTV', 'android'),
             'LeftTV': Television('LeftTV', 'android')
         }
-        self.tvs['TopTV'].connect(os.getenv('TopTVIP'))
-        self.tvs['RightTV'].connect(os.getenv('RightTVIP'))
-        self.tvs['LeftTV'].connect(os.getenv('LeftTVIP'))
+        # connect to all TVs at once so startup only waits on the slowest TV rather than the sum of all three
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            futures = {ex.submit(self.tvs[name].connect, ip): name for name, ip in TV_IPS.items()}
+        # a TV that failed to connect should not keep the others from being controlled
+        for f, name in futures.items():
+            e = f.exception()
+            if e:
+                sg.popup_error(f"{name} failed to connect: {e}")
         # layout the GUI as a tv controller with a drop down menu for which tv to control
         layout = [
             [sg.Text('Select TV:', font='Any 30'),
@@ -163,69 +354,79 @@ class TelevisionGUI:
 
         self.window = sg.Window('TV Control', layout, finalize=True, size=(400, 400), auto_size_buttons=True,
                                 auto_size_text=True)
-        # Leave the GUI open until window closed
+        # popups can only be opened from the GUI thread, so the TV workers post their errors as window events
+        for tv in self.tvs.values():
+            tv.on_error = partial(self.window.write_event_value, 'Error')
+        # map each button to the command it forwards to the selected tv
+        # Connect also needs the ip typed in, which is read from the values of the current event
+        handlers = {
+            'Connect': lambda tv_name: self.connect(values['tv_ip'], tv_name),
+            'Mute': self.mute,
+            'Unmute': self.unmute,
+            '↑': self.up,
+            '↓': self.down,
+            '←': self.left,
+            '→': self.right,
+            'Select': self.select,
+            'Back': self.back
+        }
+        # Leave the GUI open until window closed, polling with a timeout so Tk keeps pumping while TVs respond
         while True:
-            event, values = self.window.read()
+            event, values = self.window.read(timeout=50)
             if event == sg.WIN_CLOSED:
                 break
-            elif event == 'Connect':
-                self.connect(values['tv_ip'], values['tv_select'])
-            elif event == 'Mute':
-                self.mute(values['tv_select'])
-            elif event == 'Unmute':
-                self.unmute(values['tv_select'])
-            elif event == '↑':
-                self.up(values['tv_select'])
-            elif event == '↓':
-                self.down(values['tv_select'])
-            elif event == '←':
-                self.left(values['tv_select'])
-            elif event == '→':
-                self.right(values['tv_select'])
-            elif event == 'Select':
-                self.select(values['tv_select'])
-            elif event == 'Back':
-                self.back(values['tv_select'])
+            elif event == 'Error':
+                sg.popup_error(values[event])
+            elif event == 'Connected':
+                sg.popup(f"{values[event]} connected successfully!")
+            fn = handlers.get(event)
+            if fn:
+                fn(values['tv_select'])
 
     # Forward on the GUI command to the specific instance of a Television variable
+    # connecting is queued on the tv's worker so it waits for commands in flight and does not freeze the GUI
     def connect(self, ip, tv_name):
+        tv = self.tvs.get(tv_name)
+        if tv is not None:
+            tv._q.put(partial(self._connect, tv, ip))
+
+    # runs on the tv's worker, the result is posted back to the GUI thread to be shown in a popup
+    def _connect(self, tv, ip):
         try:
-            self.tvs[tv_name].connect(ip)
-            sg.popup(f"{tv_name} connected successfully!")
+            tv.connect(ip)
+            self.window.write_event_value('Connected', tv.name)
         except Exception as e:
-            sg.popup_error(str(e))
+            self.window.write_event_value('Error', str(e))
+
+    # queue the named command on the selected tv's worker, nothing is sent if no tv is selected
+    def _send(self, tv_name, method):
+        tv = self.tvs.get(tv_name)
+        if tv is not None:
+            tv._q.put(getattr(tv, method))
 
     def mute(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].mute()
+        self._send(tv_name, 'mute')
 
     def unmute(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].unmute()
+        self._send(tv_name, 'unmute')
 
     def up(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].up()
+        self._send(tv_name, 'up')
 
     def down(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].down()
+        self._send(tv_name, 'down')
 
     def left(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].left()
+        self._send(tv_name, 'left')
 
     def right(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].right()
+        self._send(tv_name, 'right')
 
     def back(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].back()
+        self._send(tv_name, 'back')
 
     def select(self, tv_name):
-        if self.tvs[tv_name]:
-            self.tvs[tv_name].select()
+        self._send(tv_name, 'select')
 
 
 # Test